@@ -1,9 +1,13 @@
 import bpy
 from bpy.types import Operator, Panel
-from bpy.props import EnumProperty, BoolProperty
+from bpy.props import EnumProperty, BoolProperty, IntProperty, FloatProperty
+from bisect import bisect_left
+from functools import partial
 from bpy.app.translations import pgettext
 from . import op_convert
 from . import op_replace
+from . import op_match
+from .modal_batch import ModalBatch, restore_names
 
 bl_info = {
     "name": "Mio3 Bones",
@@ -31,7 +35,9 @@ def restore_current_selection(armature, current_selection):
     if armature.use_mirror_x:
         bpy.ops.armature.select_all(action="DESELECT")
         for bone_name, select_head, select_tail in current_selection:
-            bone = armature.edit_bones[bone_name]
+            bone = armature.edit_bones.get(bone_name)
+            if bone is None:
+                continue
             bone.select = True
             bone.select_head = select_head
             bone.select_tail = select_tail
@@ -52,27 +58,42 @@ def split_bone_chains(selected_bones):
     return bone_chains
 
 
-class MIO3_OT_bone_evenly(Operator):
+class MIO3_OT_bone_evenly(Operator, ModalBatch):
     bl_idname = "armature.mio3_bone_evenly"
     bl_label = "Evenly Bones"
     bl_description = "ボーンの長さを均等にする"
     bl_options = {"REGISTER", "UNDO"}
 
-    def execute(self, context):
+    def build_batch(self, context):
         bpy.ops.object.mode_set(mode="OBJECT")
         bpy.ops.object.mode_set(mode="EDIT")
 
         armature = context.active_object.data
-        current_selection = select_current_selection(armature)
+        self.current_selection = select_current_selection(armature)
 
         selected_bones = context.selected_bones
-        if selected_bones:
-            bone_chains = split_bone_chains(selected_bones)
-            for chain in bone_chains:
-                self.evenly(chain)
+        self.bone_chains = split_bone_chains(selected_bones) if selected_bones else []
+        return [partial(self.evenly, chain) for chain in self.bone_chains]
 
-        restore_current_selection(armature, current_selection)
-        return {"FINISHED"}
+    def batch_size(self, items):
+        return sum(len(chain) for chain in self.bone_chains)
+
+    def take_snapshot(self, context):
+        return [
+            (bone.name, bone.head.copy(), bone.tail.copy())
+            for chain in self.bone_chains
+            for bone in chain
+        ]
+
+    def restore_snapshot(self, context, snapshot):
+        edit_bones = context.active_object.data.edit_bones
+        for name, head, tail in snapshot:
+            bone = edit_bones[name]
+            bone.head = head
+            bone.tail = tail
+
+    def finish_batch(self, context):
+        restore_current_selection(context.active_object.data, self.current_selection)
 
     # 反復して調整
     def evenly(self, chain, iterations=3):
@@ -107,6 +128,138 @@ class MIO3_OT_bone_evenly(Operator):
             chain[-1].tail = original_positions[-1][1]
 
 
+# 1 チェーンあたりのボーン数の上限
+MAX_RESAMPLE_COUNT = 1000
+
+
+class MIO3_OT_bone_resample(Operator):
+    bl_idname = "armature.mio3_bone_resample"
+    bl_label = "Resample Bones"
+    bl_description = "チェーンの形状を保ったままボーン数を変更する"
+    bl_options = {"REGISTER", "UNDO"}
+
+    mode: EnumProperty(
+        name="Mode",
+        default="COUNT",
+        items=[
+            ("COUNT", "Count", ""),
+            ("LENGTH", "Length", ""),
+        ],
+    )
+    count: IntProperty(name="Count", default=4, min=1, max=MAX_RESAMPLE_COUNT)
+    length: FloatProperty(
+        name="Length", default=0.05, min=0.0001, subtype="DISTANCE", unit="LENGTH"
+    )
+    numbering: BoolProperty(name="Numbering Bones", default=True)
+    delim: EnumProperty(
+        name="Delim",
+        default=".",
+        items=[
+            (".", "Dot (.)", ""),
+            ("_", "Under Bar (_)", ""),
+        ],
+    )
+    endbone: BoolProperty(name="EndBone", default=False)
+    suffix: BoolProperty(name="Suffix L/R", default=False)
+
+    def draw(self, context):
+        layout = self.layout
+        layout.prop(self, "mode", expand=True)
+        if self.mode == "COUNT":
+            layout.prop(self, "count")
+        else:
+            layout.prop(self, "length")
+        layout.prop(self, "numbering")
+        col = layout.column()
+        col.enabled = self.numbering
+        col.prop(self, "delim")
+        col.prop(self, "endbone")
+        col.prop(self, "suffix")
+
+    def execute(self, context):
+        bpy.ops.object.mode_set(mode="OBJECT")
+        bpy.ops.object.mode_set(mode="EDIT")
+
+        armature = context.active_object.data
+        current_selection = select_current_selection(armature)
+
+        selected_bones = context.selected_bones
+        if selected_bones:
+            bone_chains = split_bone_chains(selected_bones)
+            for chain in bone_chains:
+                self.resample(armature, chain)
+
+        restore_current_selection(armature, current_selection)
+        return {"FINISHED"}
+
+    # 元のチェーンの折れ線から距離テーブルを作り、新しい関節位置を求める
+    def resample(self, armature, chain):
+        points = [chain[0].head.copy()] + [bone.tail.copy() for bone in chain]
+        sum_distances = [0.0]
+        for i in range(len(chain)):
+            sum_distances.append(sum_distances[-1] + (points[i + 1] - points[i]).length)
+        total_length = sum_distances[-1]
+        if total_length == 0.0:
+            return
+
+        if self.mode == "COUNT":
+            count = self.count
+        else:
+            count = max(1, min(round(total_length / self.length), MAX_RESAMPLE_COUNT))
+
+        positions = [points[0]]
+        segment_indices = []
+        for i in range(1, count + 1):
+            distance = total_length * i / count
+            index = min(bisect_left(sum_distances, distance, 1) - 1, len(chain) - 1)
+            segment = sum_distances[index + 1] - sum_distances[index]
+            t = (distance - sum_distances[index]) / segment if segment else 0.0
+            positions.append(points[index].lerp(points[index + 1], t))
+            segment_indices.append(index)
+        positions[-1] = points[-1]
+
+        rolls = [bone.roll for bone in chain]
+        chain_set = set(chain)
+        tip_children = [child for child in chain[-1].children if child not in chain_set]
+
+        bones = chain[:count]
+        for i in range(len(chain), count):
+            source = chain[segment_indices[i]]
+            bone = armature.edit_bones.new(chain[0].name)
+            bone.head = positions[i]
+            bone.tail = positions[i + 1]
+            bone.parent = bones[-1]
+            bone.use_connect = True
+            bone.use_deform = source.use_deform
+            if hasattr(source, "collections"):
+                for collection in source.collections:
+                    collection.assign(bone)
+            else:
+                bone.layers = source.layers
+            bone.select = True
+            bone.select_head = True
+            bone.select_tail = True
+            bones.append(bone)
+
+        for i, bone in enumerate(bones):
+            bone.head = positions[i]
+            bone.tail = positions[i + 1]
+            bone.roll = rolls[segment_indices[i]]
+
+        for child in tip_children:
+            child.parent = bones[-1]
+        for bone in chain[count:]:
+            for child in bone.children:
+                if child not in chain_set:
+                    child.use_connect = False
+                    child.parent = bones[-1]
+        for bone in chain[count:]:
+            armature.edit_bones.remove(bone)
+
+        if self.numbering:
+            numbering_chain(bones, self.delim, self.endbone, self.suffix)
+
+
 class MIO3_OT_bone_align(Operator):
     bl_idname = "armature.mio3_bone_align"
     bl_label = "Align Bones (child)"
@@ -170,7 +323,7 @@ def sort_bones(bone, sorted_bones, renamed_bones, selected_bones):
             sort_bones(child, sorted_bones, renamed_bones, selected_bones)
 
 
-class MIO3_OT_bone_numbering(Operator):
+class MIO3_OT_bone_numbering(Operator, ModalBatch):
     bl_idname = "armature.mio3_bone_numbering"
     bl_label = "Numbering Bones"
     bl_description = "Numbering Bone"
@@ -188,48 +341,53 @@ class MIO3_OT_bone_numbering(Operator):
     endbone: BoolProperty(name="EndBone", default=False)
     suffix: BoolProperty(name="Suffix L/R", default=False)
 
-    def execute(self, context):
+    def build_batch(self, context):
         bpy.ops.object.mode_set(mode="OBJECT")
         bpy.ops.object.mode_set(mode="EDIT")
 
         selected_bones = [bone for bone in context.selected_bones if bone.select]
-        if selected_bones:
-            bone_chains = split_bone_chains(selected_bones)
-            for chain in bone_chains:
-                self.rename_bone(chain)
-        return {"FINISHED"}
+        self.bone_chains = split_bone_chains(selected_bones) if selected_bones else []
+        return [partial(self.rename_bone, chain) for chain in self.bone_chains]
+
+    def batch_size(self, items):
+        return sum(len(chain) for chain in self.bone_chains)
+
+    def take_snapshot(self, context):
+        return [bone.name for bone in context.active_object.data.edit_bones]
+
+    def restore_snapshot(self, context, snapshot):
+        restore_names(context.active_object.data.edit_bones, snapshot)
 
     def rename_bone(self, chain):
-        name = chain[0].name
-        base_name = name
-        suffix = ""
-        if self.suffix and name.endswith(("_L", "_R", ".L", ".R")):
-            suffix = name[-2:]
-            base_name = name[:-2]
-
-        sorted_bones = []
-        renamed_bones = set()
-        for bone in chain:
-            if bone.parent not in chain:
-                sort_bones(bone, sorted_bones, renamed_bones, set(chain))
-
-        temp_names = {}
-        for i, bone in enumerate(sorted_bones):
-            temp_name = f"TEMP_mio3bones_{i:03d}_{bone.name}"
-            temp_names[bone.name] = temp_name
-            bone.name = temp_name
-
-        for i, bone in enumerate(sorted_bones):
-            original_name = list(temp_names.keys())[
-                list(temp_names.values()).index(bone.name)
-            ]
-            if original_name != name:
-                if self.endbone and i == len(sorted_bones) - 1:
-                    bone.name = f"{base_name}{self.delim}end{suffix}"
-                else:
-                    bone.name = f"{base_name}{self.delim}{i:03d}{suffix}"
+        numbering_chain(chain, self.delim, self.endbone, self.suffix)
+
+
+def numbering_chain(chain, delim, endbone=False, use_suffix=False):
+    name = chain[0].name
+    base_name = name
+    suffix = ""
+    if use_suffix and name.endswith(("_L", "_R", ".L", ".R")):
+        suffix = name[-2:]
+        base_name = name[:-2]
+
+    sorted_bones = []
+    renamed_bones = set()
+    for bone in chain:
+        if bone.parent not in chain:
+            sort_bones(bone, sorted_bones, renamed_bones, set(chain))
+
+    original_names = [bone.name for bone in sorted_bones]
+    for i, bone in enumerate(sorted_bones):
+        bone.name = f"TEMP_mio3bones_{i:03d}_{bone.name}"
+
+    for i, bone in enumerate(sorted_bones):
+        if original_names[i] != name:
+            if endbone and i == len(sorted_bones) - 1:
+                bone.name = f"{base_name}{delim}end{suffix}"
             else:
-                bone.name = name
+                bone.name = f"{base_name}{delim}{i:03d}{suffix}"
+        else:
+            bone.name = name
 
 
 def menu(self, context):
@@ -245,6 +403,9 @@ def menu_transform(self, context):
     self.layout.operator(
         MIO3_OT_bone_evenly.bl_idname, text=pgettext(MIO3_OT_bone_evenly.bl_label)
     )
+    self.layout.operator(
+        MIO3_OT_bone_resample.bl_idname, text=pgettext(MIO3_OT_bone_resample.bl_label)
+    )
 
 
 def menu_name(self, context):
@@ -264,8 +425,11 @@ translation_dict = {
         ("*", "Numbering Bones"): "ボーンに通し番号をふる",
         ("*", "Unify roles"): "ロールを統一",
         ("*", "Preserve Length Bone"): "各ボーンの長さを維持",
+        ("*", "Resample Bones"): "ボーン数を変更",
 
         ("*", "After Format"): "変換後",
+        ("*", "Generate Preset"): "プリセットを作成",
+        ("*", "Replace (CSV)"): "CSVで置換",
 
     }
 }
@@ -280,7 +444,13 @@ class MIO3BONE_PT_Main(Panel):
         layout = self.layout
 
 
-classes = [MIO3_OT_bone_evenly, MIO3_OT_bone_align, MIO3_OT_bone_numbering, MIO3BONE_PT_Main]
+classes = [
+    MIO3_OT_bone_evenly,
+    MIO3_OT_bone_resample,
+    MIO3_OT_bone_align,
+    MIO3_OT_bone_numbering,
+    MIO3BONE_PT_Main,
+]
 
 
 def register():
@@ -289,6 +459,7 @@ def register():
         bpy.utils.register_class(cls)
     op_convert.register()
     op_replace.register()
+    op_match.register()
     bpy.types.VIEW3D_MT_transform_armature.append(menu_transform)
     bpy.types.VIEW3D_MT_edit_armature_names.append(menu_name)
     bpy.types.VIEW3D_MT_armature_context_menu.append(menu)
@@ -299,6 +470,7 @@ def unregister():
         bpy.utils.unregister_class(cls)
     op_convert.unregister()
     op_replace.unregister()
+    op_match.unregister()
     bpy.types.VIEW3D_MT_transform_armature.remove(menu_transform)
     bpy.types.VIEW3D_MT_edit_armature_names.remove(menu_name)
     bpy.types.VIEW3D_MT_armature_context_menu.remove(menu)
@@ -0,0 +1,127 @@
+import time
+from bpy.app.translations import pgettext
+
+# これ以上の処理単位があるときはモーダルで分割実行する
+MODAL_THRESHOLD = 2000
+# 1 回のタイマーイベントで処理に使う秒数の最小値と最大値
+TIME_BUDGET = 0.1
+MAX_TIME_BUDGET = 1.0
+# 処理の合間（再描画やタイマー待ち）に使ってよい時間の割合
+IDLE_RATIO = 0.03
+
+
+# 処理を呼び出し可能なオブジェクトのリストに分けて実行する
+# 小さい処理は execute で同期実行し、大きい処理はタイマーで区切ってモーダル実行する
+# 継承先は build_batch を実装し、必要に応じて batch_size / take_snapshot / restore_snapshot / finish_batch を実装する
+class ModalBatch:
+    def build_batch(self, context):
+        return []
+
+    # モーダルにするかの判定に使う処理量（1 項目で複数のボーンを扱うときは上書きする）
+    def batch_size(self, items):
+        return len(items)
+
+    def take_snapshot(self, context):
+        return None
+
+    def restore_snapshot(self, context, snapshot):
+        pass
+
+    def finish_batch(self, context):
+        pass
+
+    def execute(self, context):
+        items = self.build_batch(context)
+        if items is None:
+            return {"CANCELLED"}
+        return self.run_batch(context, items)
+
+    def invoke(self, context, event):
+        items = self.build_batch(context)
+        if items is None:
+            return {"CANCELLED"}
+        if self.batch_size(items) < MODAL_THRESHOLD:
+            return self.run_batch(context, items)
+
+        self._items = items
+        self._index = 0
+        self._budget = TIME_BUDGET
+        self._slice_end = None
+        self._snapshot = self.take_snapshot(context)
+        wm = context.window_manager
+        wm.progress_begin(0, len(items))
+        self._timer = wm.event_timer_add(0.001, window=context.window)
+        wm.modal_handler_add(self)
+        return {"RUNNING_MODAL"}
+
+    def run_batch(self, context, items):
+        for item in items:
+            item()
+        self.finish_batch(context)
+        return {"FINISHED"}
+
+    def modal(self, context, event):
+        if event.type == "ESC":
+            self.cancel(context)
+            self.report({"WARNING"}, "Cancelled")
+            return {"CANCELLED"}
+
+        if event.type != "TIMER" or event.timer != self._timer:
+            return {"RUNNING_MODAL"}
+
+        # 前回の処理から今回までの時間（再描画など）を測り、それが処理時間の
+        # IDLE_RATIO 程度に収まるよう 1 回の処理時間を伸ばす
+        start = time.perf_counter()
+        if self._slice_end is not None:
+            idle = start - self._slice_end
+            self._budget = min(max(TIME_BUDGET, idle / IDLE_RATIO), MAX_TIME_BUDGET)
+
+        items = self._items
+        index = self._index
+        total = len(items)
+        deadline = start + self._budget
+        while index < total:
+            items[index]()
+            index += 1
+            if time.perf_counter() > deadline:
+                break
+        self._index = index
+
+        if index >= total:
+            self.end_modal(context)
+            return {"FINISHED"}
+
+        context.window_manager.progress_update(index)
+        context.workspace.status_text_set(
+            f"{pgettext(self.bl_label)}: {index} / {total}  (Esc: {pgettext('Cancel')})"
+        )
+        self._slice_end = time.perf_counter()
+        return {"RUNNING_MODAL"}
+
+    # Esc のほか、ウィンドウを閉じたりファイルを読み込んだりして中断されたときも呼ばれる
+    def cancel(self, context):
+        if getattr(self, "_items", None) is None:
+            return
+        self.restore_snapshot(context, self._snapshot)
+        self.end_modal(context)
+
+    def end_modal(self, context):
+        wm = context.window_manager
+        wm.event_timer_remove(self._timer)
+        wm.progress_end()
+        if context.workspace:
+            context.workspace.status_text_set(None)
+        self.finish_batch(context)
+        self._items = None
+        self._snapshot = None
+
+
+# 名前を変更前に戻す（重複で名前が変わらないよう一度仮の名前にする）
+def restore_names(bones, names):
+    changed = [
+        (bone, name) for bone, name in zip(bones, names) if bone.name != name
+    ]
+    for i, (bone, name) in enumerate(changed):
+        bone.name = f"TEMP_mio3bones_{i}"
+    for bone, name in changed:
+        bone.name = name
@@ -1,5 +1,6 @@
 import bpy
 import re
+from functools import partial
 from bpy.props import (
     BoolProperty,
     IntProperty,
@@ -10,6 +11,8 @@ from bpy.props import (
 )
 from bpy.types import Operator, Panel, PropertyGroup
 from bpy.app.translations import pgettext
+from .modal_batch import ModalBatch, restore_names
+from .op_match import poll_match_reference
 
 
 class MIO3BONE_PG_PrefixItem(PropertyGroup):
@@ -63,12 +66,30 @@ class MIO3BONE_Props(PropertyGroup):
         ],
         default="UpperArm_L",
     )
+    convert_scope: EnumProperty(
+        name="Scope",
+        items=[
+            ("VISIBLE", "Visible", "表示されているボーン"),
+            ("SELECTED", "Selected", "選択されているボーン"),
+            ("COLLECTION", "Collection", "ボーンコレクションに含まれるボーン"),
+            ("CHILDREN", "Children", "アクティブボーンとその子孫"),
+            ("REGEX", "Regex", "名前が正規表現に一致するボーン"),
+        ],
+        default="VISIBLE",
+    )
+    scope_collections: StringProperty(
+        name="Collections", description="カンマ区切りで複数指定できます"
+    )
+    scope_regex: StringProperty(name="Regex")
+    match_reference: PointerProperty(
+        name="Reference", type=bpy.types.Object, poll=poll_match_reference
+    )
 
 
-class MIO3BONE_OT_ConvertNames(Operator):
+class MIO3BONE_OT_ConvertNames(Operator, ModalBatch):
     bl_idname = "armature.convert_bone_names"
     bl_label = "Convert Bone Names"
-    bl_description = "ポーズモードで表示されているボーンの名前を変換します"
+    bl_description = "対象範囲のボーンの名前を変換します"
     bl_options = {"REGISTER", "UNDO"}
 
     conventions = {
@@ -137,18 +158,20 @@ class MIO3BONE_OT_ConvertNames(Operator):
         },
     )
 
-    def detect_name_component(self, bone_name, prefixes):
+    @classmethod
+    def detect_name_component(cls, bone_name, prefixes):
         prefix = ""
         base = bone_name
         for p in prefixes:
             if bone_name.startswith(p):
                 prefix = p
                 base = bone_name[len(p) :]
-        name, side, number = self.detect_pattern(base)
+        name, side, number = cls.detect_pattern(base)
         return prefix, name, side, number
 
-    def detect_pattern(self, name):
-        for data in self.patterns:
+    @classmethod
+    def detect_pattern(cls, name):
+        for data in cls.patterns:
             match = re.match(data["pattern"], name)
             if match:
                 if data["side_type"] == "suffix":
@@ -159,11 +182,12 @@ class MIO3BONE_OT_ConvertNames(Operator):
                     return match.group(1), "", match.group(2) or ""
         return name, "", ""
 
-    def join_name_component(self, prefix, name, side, number, convert_type):
-        conv_data = self.conventions[convert_type]
+    @classmethod
+    def join_name_component(cls, prefix, name, side, number, convert_type):
+        conv_data = cls.conventions[convert_type]
         if side == "":
             return "".join([name, number])
-        elif self.conventions[convert_type]["side_type"] == "suffix":
+        elif cls.conventions[convert_type]["side_type"] == "suffix":
             newstr = "".join(
                 [prefix, name, conv_data["side_format"].format(side), number]
             )
@@ -173,13 +197,14 @@ class MIO3BONE_OT_ConvertNames(Operator):
             )
         return newstr
 
-    def convert_name(self, name, to_conv):
+    @classmethod
+    def convert_name(cls, name, to_conv):
         if re.match(r"^[a-zA-Z0-9\s_.\-]+$", name):
             words = re.findall(r"[A-Z][a-z]*|[a-z]+", name)
         else:
             words = [name]
-        separator = self.conventions[to_conv]["separator"]
-        if self.conventions[to_conv]["separator"] == "":
+        separator = cls.conventions[to_conv]["separator"]
+        if cls.conventions[to_conv]["separator"] == "":
             newstr = separator.join(word.capitalize() for word in words)
         else:
             newstr = separator.join(words)
@@ -190,38 +215,119 @@ class MIO3BONE_OT_ConvertNames(Operator):
         obj = context.active_object
         return obj is not None and obj.type == "ARMATURE"
 
-    def execute(self, context):
+    def build_batch(self, context):
         armature = context.active_object
         if armature.type != "ARMATURE":
             self.report({"ERROR"}, "アーマチュアを選択してください")
-            return {"CANCELLED"}
+            return None
 
         props = context.scene.mio3bone
-        convert_type = props.convert_types
-        prefixs = [item.prefix for item in context.scene.mio3bone.prefixs.items]
-
-        for bone in armature.pose.bones:
-            if not bone.bone.hide:
-                prefix, name, side, number = self.detect_name_component(
-                    bone.name, prefixs
-                )
-                if context.scene.mio3bone.remove_prefix:
-                    prefix = ""
-
-                if context.scene.mio3bone.side_long:
-                    side = "Left" if side == "L" else side
-                    side = "Right" if side == "R" else side
-                else:
-                    side = side[0] if side in ["Left", "Right"] else side
+        prefixs = [item.prefix for item in props.prefixs.items]
+
+        try:
+            target_bones = self.get_target_bones(armature, props)
+        except re.error:
+            self.report({"ERROR"}, "正規表現が正しくありません")
+            return None
+
+        return [
+            partial(
+                self.convert_bone,
+                bone,
+                prefixs,
+                props.convert_types,
+                props.remove_prefix,
+                props.side_long,
+            )
+            for bone in target_bones
+        ]
 
-                name = self.convert_name(name, convert_type)
-                new_name = self.join_name_component(
-                    prefix, name, side, number, convert_type
-                )
-                if new_name != bone.name:
-                    bone.name = new_name
+    def take_snapshot(self, context):
+        return [bone.name for bone in context.active_object.data.bones]
 
-        return {"FINISHED"}
+    def restore_snapshot(self, context, snapshot):
+        restore_names(context.active_object.data.bones, snapshot)
+
+    @classmethod
+    def convert_bone(cls, bone, prefixs, convert_type, remove_prefix, side_long):
+        prefix, name, side, number = cls.detect_name_component(bone.name, prefixs)
+        if remove_prefix:
+            prefix = ""
+
+        if side_long:
+            side = "Left" if side == "L" else side
+            side = "Right" if side == "R" else side
+        else:
+            side = side[0] if side in ["Left", "Right"] else side
+
+        name = cls.convert_name(name, convert_type)
+        new_name = cls.join_name_component(prefix, name, side, number, convert_type)
+        if new_name != bone.name:
+            bone.name = new_name
+
+    # 変換対象のボーンを絞り込む（コレクションと子孫はメンバーを直接参照）
+    @classmethod
+    def get_target_bones(cls, obj, props):
+        scope = props.convert_scope
+        if scope in {"COLLECTION", "CHILDREN"}:
+            return cls.get_scope_members(obj, props)
+
+        bones = obj.data.bones
+        count = len(bones)
+        if scope == "VISIBLE":
+            hide = [False] * count
+            bones.foreach_get("hide", hide)
+            mask = [not h for h in hide]
+        elif scope == "SELECTED":
+            mask = [False] * count
+            bones.foreach_get("select", mask)
+        else:
+            pattern = re.compile(props.scope_regex)
+            mask = [bool(pattern.search(bone.name)) for bone in bones]
+
+        return [bones[i] for i in range(count) if mask[i]]
+
+    @classmethod
+    def get_scope_members(cls, obj, props):
+        armature = obj.data
+        if props.convert_scope == "CHILDREN":
+            active = armature.bones.active
+            if active is None:
+                return []
+            bones = []
+            stack = [active]
+            while stack:
+                bone = stack.pop()
+                bones.append(bone)
+                stack.extend(bone.children)
+            return bones
+
+        names = [name.strip() for name in props.scope_collections.split(",")]
+        names = [name for name in names if name]
+
+        # Blender 4.0 以降はボーンコレクション、それ以前はボーングループ
+        if hasattr(armature, "collections"):
+            collections = getattr(armature, "collections_all", armature.collections)
+            bones = []
+            seen = set()
+            for name in names:
+                collection = collections.get(name)
+                if collection is None:
+                    continue
+                for bone in collection.bones:
+                    if bone.name not in seen:
+                        seen.add(bone.name)
+                        bones.append(bone)
+            return bones
+
+        groups = {name for name in names if name in obj.pose.bone_groups}
+        if not groups:
+            return []
+        return [
+            pb.bone
+            for pb in obj.pose.bones
+            if pb.bone_group and pb.bone_group.name in groups
+        ]
 
 
 class MIO3BONE_OT_PrefixAdd(bpy.types.Operator):
@@ -263,6 +369,11 @@ class MIO3BONE_PT_Convert(Panel):
         props = context.scene.mio3bone
         layout.label(text="Name Converter")
         layout.prop(props, "convert_types")
+        layout.prop(props, "convert_scope")
+        if props.convert_scope == "COLLECTION":
+            layout.prop(props, "scope_collections")
+        elif props.convert_scope == "REGEX":
+            layout.prop(props, "scope_regex")
         layout.operator("armature.convert_bone_names", text="Convert")
 
         layout.label(text="カスタムプレフィックス")
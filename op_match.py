@@ -0,0 +1,252 @@
+import bpy
+import csv
+from math import log
+from bpy_extras.io_utils import ExportHelper
+from bpy.props import StringProperty
+from bpy.types import Operator
+from mathutils import Vector
+from mathutils.kdtree import KDTree
+
+# 親の対応先から何階層下まで候補として探すか
+SEARCH_DEPTH = 3
+# 対応のない祖先を飛ばしたときも、探す階層はこれを超えない
+MAX_SEARCH_DEPTH = 6
+# 位置が近い順に調べる候補の数
+NEAREST_COUNT = 16
+# 位置のずれはボーンの長さを単位にする（短すぎるボーンはこの長さとみなす）
+MIN_BONE_LENGTH = 0.01
+# これよりコストが大きい候補は対応なしとする（ボーンの長さ単位）
+MATCH_THRESHOLD = 1.0
+# 子の位置がソース側の部分木と合わないときのコスト
+INCONSISTENT_COST = 0.6
+
+
+# アーマチュアの階層と正規化した位置をまとめたもの
+class RigSignature:
+    def __init__(self, bones):
+        self.names = [bone.name for bone in bones]
+        index = {name: i for i, name in enumerate(self.names)}
+        self.parents = [
+            index[bone.parent.name] if bone.parent else -1 for bone in bones
+        ]
+        self.children = [[] for _ in bones]
+        for i, parent in enumerate(self.parents):
+            if parent >= 0:
+                self.children[parent].append(i)
+
+        self.roots = [i for i, parent in enumerate(self.parents) if parent < 0]
+        self.order = []
+        self.depths = [0] * len(bones)
+        stack = list(reversed(self.roots))
+        while stack:
+            i = stack.pop()
+            self.order.append(i)
+            for child in reversed(self.children[i]):
+                self.depths[child] = self.depths[i] + 1
+                stack.append(child)
+
+        # 部分木のサイズと、分岐のない鎖の長さ
+        # order は前順なので、部分木は order 上の連続した範囲になる
+        self.sizes = [1] * len(bones)
+        self.chains = [1] * len(bones)
+        for i in reversed(self.order):
+            for child in self.children[i]:
+                self.sizes[i] += self.sizes[child]
+            if len(self.children[i]) == 1:
+                self.chains[i] += self.chains[self.children[i][0]]
+        self.main_children = [
+            max(children, key=lambda c: self.sizes[c]) if children else -1
+            for children in self.children
+        ]
+        self.positions = [0] * len(bones)
+        for position, i in enumerate(self.order):
+            self.positions[i] = position
+
+        heads = [bone.head_local.copy() for bone in bones]
+        tails = [bone.tail_local.copy() for bone in bones]
+        self.normalize(heads, tails)
+
+        self.kdtree = KDTree(len(bones))
+        for i, head in enumerate(self.heads):
+            self.kdtree.insert(head, i)
+        self.kdtree.balance()
+
+    # ルートを原点、全体の高さを 1 として正規化
+    def normalize(self, heads, tails):
+        points = heads + tails
+        if not points:
+            self.heads, self.tails, self.lengths = [], [], []
+            self.directions, self.sides = [], []
+            return
+        low = Vector([min(p[axis] for p in points) for axis in range(3)])
+        high = Vector([max(p[axis] for p in points) for axis in range(3)])
+        scale = max(high - low) or 1.0
+        root = max(self.roots, key=lambda i: self.sizes[i])
+        origin = Vector((heads[root].x, heads[root].y, low.z))
+
+        self.heads = [(head - origin) / scale for head in heads]
+        self.tails = [(tail - origin) / scale for tail in tails]
+        self.lengths = [
+            max((tail - head).length, MIN_BONE_LENGTH)
+            for head, tail in zip(self.heads, self.tails)
+        ]
+        self.directions = [
+            (tail - head).normalized() for head, tail in zip(heads, tails)
+        ]
+        # 中心付近から伸びるボーン（肩など）もあるので、中点で左右を判定する
+        centers = [(head.x + tail.x) / 2 for head, tail in zip(self.heads, self.tails)]
+        self.sides = ["L" if x > 0.01 else "R" if x < -0.01 else "C" for x in centers]
+
+    # j が i の部分木の depth 階層以内にあるか
+    def in_subtree(self, i, j, depth):
+        start = self.positions[i]
+        return (
+            start <= self.positions[j] < start + self.sizes[i]
+            and self.depths[j] - self.depths[i] <= depth
+        )
+
+    def nearest(self, co, count):
+        return [index for _, index, _ in self.kdtree.find_n(co, count)]
+
+
+# 位置は親の対応先からの相対位置で比べるので、腕の長さなど体型の違いに左右されにくい
+def match_cost(ref, a, src, b, offset):
+    if ref.sides[a] != src.sides[b]:
+        return float("inf")
+    length = ref.lengths[a]
+    cost = (ref.heads[a] - offset - src.heads[b]).length / length
+    cost += (ref.tails[a] - offset - src.tails[b]).length / length * 0.5
+    cost += (1.0 - ref.directions[a].dot(src.directions[b])) * 0.2
+    cost += abs(log(ref.sizes[a] / src.sizes[b])) * 0.02
+    cost += abs(ref.chains[a] - src.chains[b]) * 0.01
+    return cost
+
+
+# 基準側で一番大きな子の位置に近いソースのボーンが、b の部分木にあるか
+def is_consistent(ref, a, src, b, offset):
+    child = ref.main_children[a]
+    if child < 0:
+        return True
+    for j in src.nearest(ref.heads[child] - offset, 4):
+        if src.in_subtree(b, j, MAX_SEARCH_DEPTH):
+            return True
+    return False
+
+
+# 基準アーマチュアのボーン名 -> ソースのボーン名
+def match_rigs(ref, src):
+    if not ref.roots or not src.roots:
+        return {}
+
+    partners = {}
+    used = set()
+
+    # 親の対応先を探す。対応のない親は飛ばして祖先をたどる
+    def find_anchor(i):
+        skipped = 0
+        parent = ref.parents[i]
+        while parent >= 0 and parent not in partners:
+            parent = ref.parents[parent]
+            skipped += 1
+        return parent, skipped
+
+    # 親の対応先のひとつ上から探すので、対応先の兄弟とその部分木も候補になる
+    def search_region(i):
+        anchor, skipped = find_anchor(i)
+        if anchor < 0:
+            return None, 0, Vector((0.0, 0.0, 0.0))
+        region = partners[anchor]
+        offset = ref.heads[anchor] - src.heads[region]
+        depth = min(SEARCH_DEPTH + skipped, MAX_SEARCH_DEPTH)
+        if src.parents[region] >= 0:
+            region = src.parents[region]
+            depth += 1
+        return region, depth, offset
+
+    def find_best(i, region, depth, offset, count):
+        best, best_cost = None, MATCH_THRESHOLD
+        for j in src.nearest(ref.heads[i] - offset, count):
+            if j in used:
+                continue
+            if region is not None and not src.in_subtree(region, j, depth):
+                continue
+            cost = match_cost(ref, i, src, j, offset)
+            if cost >= best_cost:
+                continue
+            if not is_consistent(ref, i, src, j, offset):
+                cost += INCONSISTENT_COST
+            if cost < best_cost:
+                best, best_cost = j, cost
+        return best
+
+    # 近くの候補がすべて使用済みや範囲外のときは、候補を増やしてもう一度探す
+    for i in ref.order:
+        region, depth, offset = search_region(i)
+        best = find_best(i, region, depth, offset, NEAREST_COUNT)
+        if best is None:
+            best = find_best(i, region, depth, offset, NEAREST_COUNT * 4)
+        if best is not None:
+            partners[i] = best
+            used.add(best)
+
+    return {ref.names[i]: src.names[j] for i, j in partners.items()}
+
+
+# 基準アーマチュアに指定できるオブジェクト
+def poll_match_reference(self, obj):
+    return obj.type == "ARMATURE"
+
+
+class MIO3BONE_OT_MatchPreset(Operator, ExportHelper):
+    bl_idname = "mio3bone.match_preset"
+    bl_label = "Generate Preset"
+    bl_description = "基準アーマチュアとの階層と位置の対応からプリセットCSVを作成します"
+    bl_options = {"REGISTER"}
+
+    filename_ext = ".csv"
+    filter_glob: StringProperty(default="*.csv", options={"HIDDEN"})
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        reference = context.scene.mio3bone.match_reference
+        return (
+            obj is not None
+            and obj.type == "ARMATURE"
+            and reference is not None
+            and reference != obj
+        )
+
+    def execute(self, context):
+        reference = context.scene.mio3bone.match_reference
+        source = context.active_object
+
+        ref = RigSignature(reference.data.bones)
+        src = RigSignature(source.data.bones)
+        mapping = match_rigs(ref, src)
+
+        try:
+            with open(self.filepath, "w", newline="", encoding="utf-8") as f:
+                writer = csv.writer(f)
+                for i in ref.order:
+                    name = ref.names[i]
+                    writer.writerow([name, mapping.get(name, "")])
+        except OSError:
+            self.report({"ERROR"}, "CSVファイルを書き込めません")
+            return {"CANCELLED"}
+
+        self.report({"INFO"}, f"{len(mapping)} / {len(ref.names)} bones matched")
+        return {"FINISHED"}
+
+
+classes = [MIO3BONE_OT_MatchPreset]
+
+
+def register():
+    for c in classes:
+        bpy.utils.register_class(c)
+
+
+def unregister():
+    for c in classes:
+        bpy.utils.unregister_class(c)
@@ -1,13 +1,17 @@
 import bpy
 import os
+import re
 import csv
+from functools import partial
 from bpy_extras.io_utils import ImportHelper
 from bpy.types import Operator, Panel
+from .modal_batch import ModalBatch, restore_names
+from .op_convert import MIO3BONE_OT_ConvertNames
 
 TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "templates")
 
 
-class MIO3BONE_OT_ConvertByPreset(Operator):
+class MIO3BONE_OT_ConvertByPreset(Operator, ModalBatch):
     bl_idname = "mio3bone.convert_preset"
     bl_label = "Replace"
     bl_description = "Bone name to Humanoid format"
@@ -18,8 +22,12 @@ class MIO3BONE_OT_ConvertByPreset(Operator):
         items=[
             ("VROID_HUMANOID", "VRoid → UpperArm_L", ""),
             ("MMD_HUMANOID", "MMD → UpperArm_L", ""),
+            ("CUSTOM", "CSV → UpperArm_L", ""),
         ],
     )
+    filepath: bpy.props.StringProperty(
+        subtype="FILE_PATH", options={"HIDDEN", "SKIP_SAVE"}
+    )
     reversed: bpy.props.BoolProperty(name="reversed", default=False)
     full_convert: bpy.props.BoolProperty(name="all_convert", default=True)
 
@@ -32,36 +40,110 @@ class MIO3BONE_OT_ConvertByPreset(Operator):
         obj = context.active_object
         return obj is not None and obj.type == "ARMATURE"
 
-    def execute(self, context):
-        file = os.path.join(TEMPLATE_DIR, self.files[self.type])
-        with open(file) as f:
-            reader = csv.reader(f)
-            bone_pairs = list(reader)
-
+    def build_batch(self, context):
+        if self.type == "CUSTOM":
+            file = self.filepath
+        else:
+            file = os.path.join(TEMPLATE_DIR, self.files[self.type])
+        try:
+            with open(file, encoding="utf-8") as f:
+                bone_pairs = [row for row in csv.reader(f) if len(row) >= 2]
+        except (OSError, UnicodeDecodeError):
+            self.report({"ERROR"}, "CSVファイルを読み込めません")
+            return None
+
+        armature = context.active_object
+        items = []
         for pair in bone_pairs:
             if self.reversed:
-                rename(pair[0], pair[1], context)
+                items.append(partial(rename, pair[0], pair[1], armature))
             else:
-                rename(pair[1], pair[0], context)
+                items.append(partial(rename, pair[1], pair[0], armature))
 
         if self.full_convert and self.type == "VROID_HUMANOID" and not self.reversed:
-            armature = context.active_object
+            props = context.scene.mio3bone
+            prefixs = [item.prefix for item in props.prefixs.items]
+            # 正規表現は置換後の名前で判定するため、変換の直前に照合する
+            if props.convert_scope == "REGEX":
+                try:
+                    pattern = re.compile(props.scope_regex)
+                except re.error:
+                    self.report({"ERROR"}, "正規表現が正しくありません")
+                    return None
+                target_bones = armature.data.bones
+            else:
+                pattern = None
+                target_bones = MIO3BONE_OT_ConvertNames.get_target_bones(
+                    armature, props
+                )
+
             for bone in armature.pose.bones:
-                original_name = bone.name
-                new_name = original_name
-                for prefix in self.default_prefixes:
-                    if new_name.startswith(prefix):
-                        new_name = new_name[len(prefix) :]
-                        break
-                if new_name != original_name:
-                    bone.name = new_name
-            bpy.ops.armature.convert_bone_names()
+                items.append(partial(self.remove_default_prefix, bone))
+            for bone in target_bones:
+                items.append(
+                    partial(
+                        self.convert_bone,
+                        bone,
+                        pattern,
+                        prefixs,
+                        props.convert_types,
+                        props.remove_prefix,
+                        props.side_long,
+                    )
+                )
+
+        return items
+
+    def take_snapshot(self, context):
+        return [bone.name for bone in context.active_object.data.bones]
+
+    def restore_snapshot(self, context, snapshot):
+        restore_names(context.active_object.data.bones, snapshot)
+
+    def convert_bone(self, bone, pattern, *args):
+        if pattern is None or pattern.search(bone.name):
+            MIO3BONE_OT_ConvertNames.convert_bone(bone, *args)
+
+    def remove_default_prefix(self, bone):
+        original_name = bone.name
+        new_name = original_name
+        for prefix in self.default_prefixes:
+            if new_name.startswith(prefix):
+                new_name = new_name[len(prefix) :]
+                break
+        if new_name != original_name:
+            bone.name = new_name
+
+
+class MIO3BONE_OT_ConvertByPresetFile(Operator, ImportHelper):
+    bl_idname = "mio3bone.convert_preset_file"
+    bl_label = "Replace (CSV)"
+    bl_description = "CSVのプリセットでボーン名を変換します"
+    bl_options = {"INTERNAL"}
+
+    filename_ext = ".csv"
+    filter_glob: bpy.props.StringProperty(default="*.csv", options={"HIDDEN"})
+    reversed: bpy.props.BoolProperty(name="reversed", default=False)
+
+    @classmethod
+    def poll(cls, context):
+        obj = context.active_object
+        return obj is not None and obj.type == "ARMATURE"
 
+    # 大きな CSV でも進捗と中断が使えるよう、変換は invoke から実行する
+    def execute(self, context):
+        result = bpy.ops.mio3bone.convert_preset(
+            "INVOKE_DEFAULT",
+            type="CUSTOM",
+            filepath=self.filepath,
+            reversed=self.reversed,
+        )
+        if "CANCELLED" in result:
+            return {"CANCELLED"}
         return {"FINISHED"}
 
 
-def rename(name_from, name_to, context):
-    armature = context.active_object
+def rename(name_from, name_to, armature):
     if armature.type != "ARMATURE":
         return
 
@@ -91,9 +173,18 @@ class MIO3BONE_PT_ConvertByPreset(Panel):
         layout.operator("mio3bone.convert_preset", text="MMD → UpperArm_L").type = (
             "MMD_HUMANOID"
         )
+        layout.operator("mio3bone.convert_preset_file", text="CSV → UpperArm_L")
+
+        layout.label(text="Generate Preset")
+        layout.prop(context.scene.mio3bone, "match_reference")
+        layout.operator("mio3bone.match_preset", text="Export CSV")
 
 
-classes = [MIO3BONE_OT_ConvertByPreset, MIO3BONE_PT_ConvertByPreset]
+classes = [
+    MIO3BONE_OT_ConvertByPreset,
+    MIO3BONE_OT_ConvertByPresetFile,
+    MIO3BONE_PT_ConvertByPreset,
+]
 
 
 def register():